@@ -4,18 +4,25 @@ TTS Gateway Service with Whisper Alignment
 Proxies TTS requests to Kokoro and adds word-level alignment via faster-whisper.
 """
 
-import base64
+import asyncio
+import hashlib
 import io
 import logging
 import os
 import tempfile
-from contextlib import asynccontextmanager
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack, asynccontextmanager
 from typing import Optional
 
+import av
 import httpx
+import numpy as np
+import pybase64
 from fastapi import FastAPI, HTTPException, Request, Response
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -25,31 +32,102 @@ logger = logging.getLogger(__name__)
 TTS_BACKEND_URL = os.getenv("TTS_BACKEND_URL", "http://kokoro-tts:8880")
 WHISPER_MODEL = os.getenv("WHISPER_MODEL", "tiny")
 WHISPER_DEVICE = os.getenv("WHISPER_DEVICE", "cpu")
+WHISPER_BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", "8"))
+# CTranslate2 defaults to one thread per core per call, which oversubscribes
+# the CPU when uvicorn runs multiple workers - pin it explicitly
+WHISPER_CPU_THREADS = int(os.getenv("WHISPER_CPU_THREADS", "4"))
+WHISPER_NUM_WORKERS = int(os.getenv("WHISPER_NUM_WORKERS", "1"))
+# Persistent weight cache - point at a volume so restarts mmap warm files
+# instead of re-downloading; WHISPER_OFFLINE=1 forbids downloads entirely
+WHISPER_CACHE_DIR = os.getenv("WHISPER_CACHE_DIR", "/models/whisper")
+WHISPER_OFFLINE = os.getenv("WHISPER_OFFLINE", "0") == "1"
+# Fallback temp files go to RAM-backed tmpfs when available - no disk IO,
+# no SSD wear for what is transient scratch data
+WHISPER_TMPDIR = os.getenv("WHISPER_TMPDIR", "/dev/shm" if os.path.isdir("/dev/shm") else None)
+ALIGN_CACHE_SIZE = int(os.getenv("ALIGN_CACHE_SIZE", "64"))
+TTS_CACHE_SIZE = int(os.getenv("TTS_CACHE_SIZE", "32"))
+WHISPER_CONCURRENCY = int(os.getenv("WHISPER_CONCURRENCY", "1"))
+# Set WHISPER_EAGER=0 to defer model loading to the first alignment request
+# (e.g. memory-constrained deployments that rarely use alignment)
+WHISPER_EAGER = os.getenv("WHISPER_EAGER", "1") == "1"
 
 # Global whisper model (lazy loaded)
 whisper_model = None
+_model_load_lock = threading.Lock()
+
+# Bounds concurrent Whisper runs so CTranslate2's thread pool is not
+# oversubscribed when several alignment requests arrive at once
+_whisper_sem = asyncio.Semaphore(WHISPER_CONCURRENCY)
+
+# Shared HTTP client, created in lifespan. Connection pooling + keep-alive
+# saves TCP/TLS setup on every proxied call.
+http_client: Optional[httpx.AsyncClient] = None
+
+# LRU caches: alignment results keyed by sha256 of the audio bytes, TTS audio
+# keyed by the generation parameters. Repeated identical inputs (retries,
+# regression tests, idempotent clients) skip the expensive recompute.
+_align_cache: OrderedDict[bytes, list["WordTiming"]] = OrderedDict()
+_tts_cache: OrderedDict[tuple, bytes] = OrderedDict()
+
+
+def _cache_get(cache: OrderedDict, key):
+    """Look up key in an LRU cache, refreshing its recency on a hit."""
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    return None
+
+
+def _cache_put(cache: OrderedDict, key, value, max_size: int):
+    """Insert into an LRU cache, evicting the oldest entries past capacity."""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
 
 
 def get_whisper_model():
-    """Lazy load whisper model on first use."""
+    """Lazy load whisper model on first use (safe to call from any thread)."""
     global whisper_model
     if whisper_model is None:
-        logger.info(f"Loading faster-whisper model '{WHISPER_MODEL}' on {WHISPER_DEVICE}...")
-        from faster_whisper import WhisperModel
-        whisper_model = WhisperModel(
-            WHISPER_MODEL,
-            device=WHISPER_DEVICE,
-            compute_type="int8" if WHISPER_DEVICE == "cpu" else "float16"
-        )
-        logger.info("Whisper model loaded successfully")
+        with _model_load_lock:
+            if whisper_model is None:  # re-check: another thread may have won
+                logger.info(f"Loading faster-whisper model '{WHISPER_MODEL}' on {WHISPER_DEVICE}...")
+                from faster_whisper import BatchedInferencePipeline, WhisperModel
+                # Batched pipeline packs VAD-detected segments into one forward
+                # pass, which is several times faster than sequential transcribe()
+                whisper_model = BatchedInferencePipeline(
+                    model=WhisperModel(
+                        WHISPER_MODEL,
+                        device=WHISPER_DEVICE,
+                        compute_type="int8" if WHISPER_DEVICE == "cpu" else "float16",
+                        cpu_threads=WHISPER_CPU_THREADS,
+                        num_workers=WHISPER_NUM_WORKERS,
+                        download_root=WHISPER_CACHE_DIR,
+                        local_files_only=WHISPER_OFFLINE
+                    )
+                )
+                logger.info("Whisper model loaded successfully")
     return whisper_model
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events."""
+    global http_client
     logger.info(f"TTS Gateway starting - backend: {TTS_BACKEND_URL}")
-    yield
+    if WHISPER_EAGER:
+        # Load in a thread so startup of the rest of the app isn't blocked;
+        # the first alignment request then skips the multi-second model load
+        await asyncio.to_thread(get_whisper_model)
+    async with httpx.AsyncClient(
+        base_url=TTS_BACKEND_URL,
+        timeout=60.0,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+    ) as client:
+        http_client = client
+        yield
+    http_client = None
     logger.info("TTS Gateway shutting down")
 
 
@@ -57,7 +135,8 @@ app = FastAPI(
     title="TTS Gateway with Whisper Alignment",
     description="Proxies Kokoro TTS and adds word-level alignment",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 
@@ -86,12 +165,7 @@ class AlignResponse(BaseModel):
     words: list[WordTiming]
 
 
-class SpeechWithAlignmentRequest(BaseModel):
-    model: str = "tts-1"
-    input: str
-    voice: str = "af_alloy"
-    response_format: str = "mp3"
-    speed: float = 1.0
+class SpeechWithAlignmentRequest(SpeechRequest):
     language: Optional[str] = Field(None, description="Language code for alignment")
 
 
@@ -104,49 +178,123 @@ class SpeechWithAlignmentResponse(BaseModel):
 # === Helper Functions ===
 
 async def proxy_to_tts(path: str, method: str = "GET", json_data: dict = None, follow_redirects: bool = False) -> httpx.Response:
-    """Proxy request to TTS backend."""
-    url = f"{TTS_BACKEND_URL}{path}"
-    async with httpx.AsyncClient(timeout=60.0, follow_redirects=follow_redirects) as client:
-        if method == "GET":
-            return await client.get(url)
-        elif method == "POST":
-            return await client.post(url, json=json_data)
-        else:
-            raise ValueError(f"Unsupported method: {method}")
+    """Proxy request to TTS backend via the shared connection pool."""
+    if method not in ("GET", "POST"):
+        raise ValueError(f"Unsupported method: {method}")
+    return await http_client.request(
+        method, path, json=json_data, follow_redirects=follow_redirects
+    )
+
+
+def detect_language(text: str) -> str:
+    """Guess the alignment language from the script of the input text."""
+    if len(text) < 64:
+        # Short inputs: a plain loop beats the array round-trip
+        if any('\u3040' <= c <= '\u30ff' for c in text):
+            return "ja"
+        if any('\u4e00' <= c <= '\u9fff' for c in text):
+            return "zh"
+        return "en"
+    # Vectorized scan over code points - one SIMD pass instead of a
+    # per-character Python loop on long scripts
+    cp = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    if ((cp >= 0x3040) & (cp <= 0x30ff)).any():  # hiragana/katakana
+        return "ja"
+    if ((cp >= 0x4e00) & (cp <= 0x9fff)).any():  # CJK unified ideographs
+        return "zh"
+    return "en"
+
+
+def decode_audio_to_pcm(audio_bytes: bytes) -> np.ndarray:
+    """Decode audio bytes to float32 mono 16 kHz PCM (Whisper's input format)."""
+    with av.open(io.BytesIO(audio_bytes)) as container:
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=16000)
+        chunks = []
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().ravel())
+        # Drain samples still buffered inside swresample, or the tail of
+        # the clip (and the last word's timings) is silently dropped
+        chunks.extend(r.to_ndarray().ravel() for r in resampler.resample(None))
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks)
 
 
 def transcribe_with_word_timestamps(audio_bytes: bytes, language: str = None) -> list[WordTiming]:
     """Transcribe audio and return word-level timestamps."""
+    # sha256 is hardware-accelerated (SHA-NI) on modern CPUs - hashing is
+    # negligible next to the Whisper forward pass it can skip
+    cache_key = hashlib.sha256(audio_bytes).digest()
+    cached = _cache_get(_align_cache, cache_key)
+    if cached is not None:
+        logger.info("Alignment cache hit")
+        return cached
+
     model = get_whisper_model()
 
-    # Write audio to temp file (faster-whisper needs file path)
-    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as f:
-        f.write(audio_bytes)
-        temp_path = f.name
+    # Decode once in-process - avoids a temp file round-trip and a second
+    # ffmpeg decode inside faster-whisper. On decode failure, fall back to
+    # a tmpfs-backed temp file cleaned up by the exit stack.
+    with ExitStack() as stack:
+        try:
+            audio = decode_audio_to_pcm(audio_bytes)
+        except Exception as e:
+            logger.warning(f"In-process decode failed ({e}), falling back to temp file")
+            f = stack.enter_context(
+                tempfile.NamedTemporaryFile(suffix=".mp3", dir=WHISPER_TMPDIR)
+            )
+            f.write(audio_bytes)
+            f.flush()
+            audio = f.name
+        else:
+            # Degenerate inputs (near-empty or silent) would cost a full
+            # Whisper pass for zero words - cheap O(n) checks catch them
+            if audio.size < int(0.3 * 16000):
+                logger.info("Audio shorter than 0.3s, skipping alignment")
+                return []
+            rms = float(np.sqrt(np.mean(np.square(audio))))
+            if rms < 1e-3:
+                logger.info("Audio is effectively silent, skipping alignment")
+                return []
 
-    try:
         # Transcribe with word timestamps
         segments, info = model.transcribe(
-            temp_path,
+            audio,
+            batch_size=WHISPER_BATCH_SIZE,
             word_timestamps=True,
             language=language,
             vad_filter=True,
             vad_parameters=dict(min_silence_duration_ms=200)
         )
 
-        words = []
+        # Gather columns first (SoA), round both timestamp arrays in one
+        # vectorized pass, and build the models at the very end
+        word_texts = []
+        starts_raw = []
+        ends_raw = []
         for segment in segments:
             if segment.words:
                 for word in segment.words:
-                    words.append(WordTiming(
-                        word=word.word.strip(),
-                        start=round(word.start, 3),
-                        end=round(word.end, 3)
-                    ))
-
+                    word_texts.append(word.word.strip())
+                    starts_raw.append(word.start)
+                    ends_raw.append(word.end)
+
+        starts = np.round(np.asarray(starts_raw, dtype=np.float64), 3)
+        ends = np.round(np.asarray(ends_raw, dtype=np.float64), 3)
+        words = [
+            WordTiming(word=w, start=s, end=e)
+            for w, s, e in zip(word_texts, starts.tolist(), ends.tolist())
+        ]
+
+        _cache_put(_align_cache, cache_key, words, ALIGN_CACHE_SIZE)
         return words
-    finally:
-        os.unlink(temp_path)
+
+
+async def run_alignment(audio_bytes: bytes, language: str = None) -> list[WordTiming]:
+    """Run Whisper in a worker thread so the event loop stays responsive."""
+    async with _whisper_sem:
+        return await asyncio.to_thread(transcribe_with_word_timestamps, audio_bytes, language)
 
 
 # === Endpoints ===
@@ -164,29 +312,15 @@ async def root():
 
 
 @app.get("/v1/models")
-async def list_models():
-    """Proxy to TTS backend - list models."""
-    try:
-        response = await proxy_to_tts("/v1/models")
-        return Response(
-            content=response.content,
-            status_code=response.status_code,
-            media_type="application/json"
-        )
-    except httpx.RequestError as e:
-        logger.error(f"TTS backend error: {e}")
-        raise HTTPException(status_code=503, detail="TTS service unavailable")
-
-
 @app.get("/v1/audio/voices")
-async def list_voices():
-    """Proxy to TTS backend - list voices."""
+async def proxy_passthrough(request: Request):
+    """Proxy read-only endpoints straight through to the TTS backend."""
     try:
-        response = await proxy_to_tts("/v1/audio/voices")
+        response = await proxy_to_tts(request.url.path)
         return Response(
             content=response.content,
             status_code=response.status_code,
-            media_type="application/json"
+            media_type=response.headers.get("content-type", "application/json")
         )
     except httpx.RequestError as e:
         logger.error(f"TTS backend error: {e}")
@@ -195,18 +329,19 @@ async def list_voices():
 
 @app.post("/v1/audio/speech")
 async def generate_speech(request: SpeechRequest):
-    """Proxy to TTS backend - generate speech."""
+    """Proxy to TTS backend - generate speech, streaming audio as it arrives."""
     try:
-        response = await proxy_to_tts(
-            "/v1/audio/speech",
-            method="POST",
-            json_data=request.model_dump()
+        req = http_client.build_request(
+            "POST", "/v1/audio/speech", json=request.model_dump()
         )
+        upstream = await http_client.send(req, stream=True)
 
-        if response.status_code != 200:
+        if upstream.status_code != 200:
+            content = await upstream.aread()
+            await upstream.aclose()
             return Response(
-                content=response.content,
-                status_code=response.status_code,
+                content=content,
+                status_code=upstream.status_code,
                 media_type="application/json"
             )
 
@@ -219,17 +354,19 @@ async def generate_speech(request: SpeechRequest):
         }
         content_type = content_types.get(request.response_format, "audio/mpeg")
 
-        return Response(
-            content=response.content,
-            status_code=200,
-            media_type=content_type
+        # Pipe bytes from Kokoro straight to the client - first audio byte
+        # reaches the client without buffering the whole body in memory
+        return StreamingResponse(
+            upstream.aiter_raw(),
+            media_type=content_type,
+            background=BackgroundTask(upstream.aclose)
         )
     except httpx.RequestError as e:
         logger.error(f"TTS backend error: {e}")
         raise HTTPException(status_code=503, detail="TTS service unavailable")
 
 
-@app.post("/v1/audio/align", response_model=AlignResponse)
+@app.post("/v1/audio/align", response_model=AlignResponse, response_model_exclude_unset=True)
 async def align_audio(request: AlignRequest):
     """
     Align audio and return word-level timestamps.
@@ -237,9 +374,12 @@ async def align_audio(request: AlignRequest):
     Takes base64 encoded audio and returns word timing information using Whisper.
     """
     try:
-        # Decode base64 audio
+        # Decode base64 audio (pybase64 uses SIMD codecs on large blobs);
+        # run in a thread so multi-MB uploads don't stall the event loop
         try:
-            audio_bytes = base64.b64decode(request.audio_file)
+            audio_bytes = await asyncio.to_thread(
+                pybase64.b64decode, request.audio_file, validate=False
+            )
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Invalid base64 encoding: {e}")
 
@@ -248,7 +388,7 @@ async def align_audio(request: AlignRequest):
 
         # Transcribe with word timestamps
         logger.info(f"Aligning audio ({len(audio_bytes)} bytes)")
-        words = transcribe_with_word_timestamps(audio_bytes, request.language)
+        words = await run_alignment(audio_bytes, request.language)
         logger.info(f"Found {len(words)} words")
 
         return AlignResponse(words=words)
@@ -260,7 +400,7 @@ async def align_audio(request: AlignRequest):
         raise HTTPException(status_code=500, detail=f"Alignment failed: {e}")
 
 
-@app.post("/v1/audio/speech_with_alignment", response_model=SpeechWithAlignmentResponse)
+@app.post("/v1/audio/speech_with_alignment", response_model=SpeechWithAlignmentResponse, response_model_exclude_unset=True)
 async def generate_speech_with_alignment(request: SpeechWithAlignmentRequest):
     """
     Generate speech and return both audio and word-level alignment.
@@ -271,49 +411,53 @@ async def generate_speech_with_alignment(request: SpeechWithAlignmentRequest):
     3. Returns both the audio (base64) and word timestamps
     """
     try:
-        # Step 1: Generate TTS audio
-        logger.info(f"Generating TTS for: {request.input[:50]}...")
-        tts_response = await proxy_to_tts(
-            "/v1/audio/speech",
-            method="POST",
-            json_data={
-                "model": request.model,
-                "input": request.input,
-                "voice": request.voice,
-                "response_format": request.response_format,
-                "speed": request.speed
-            }
-        )
+        # Warm the Whisper model while the TTS request is in flight - hides
+        # the cold-start load when eager startup loading hasn't finished yet
+        warmup = asyncio.create_task(asyncio.to_thread(get_whisper_model))
 
-        if tts_response.status_code != 200:
-            raise HTTPException(
-                status_code=tts_response.status_code,
-                detail=f"TTS generation failed: {tts_response.text}"
-            )
-
-        audio_bytes = tts_response.content
-        logger.info(f"TTS generated {len(audio_bytes)} bytes")
+        # Step 1: Generate TTS audio (cached for repeated identical inputs)
+        try:
+            tts_key = (request.input, request.voice, request.speed, request.response_format)
+            audio_bytes = _cache_get(_tts_cache, tts_key)
+            if audio_bytes is None:
+                logger.info(f"Generating TTS for: {request.input[:50]}...")
+                tts_response = await proxy_to_tts(
+                    "/v1/audio/speech",
+                    method="POST",
+                    json_data=request.model_dump(exclude={"language"}, exclude_none=True)
+                )
+
+                if tts_response.status_code != 200:
+                    raise HTTPException(
+                        status_code=tts_response.status_code,
+                        detail=f"TTS generation failed: {tts_response.text}"
+                    )
+
+                audio_bytes = tts_response.content
+                _cache_put(_tts_cache, tts_key, audio_bytes, TTS_CACHE_SIZE)
+                logger.info(f"TTS generated {len(audio_bytes)} bytes")
+            else:
+                logger.info("TTS cache hit")
+        except BaseException:
+            # Don't orphan the warmup task when TTS fails - an unretrieved
+            # model-load error would otherwise only show up in the task log
+            warmup.cancel()
+            raise
 
         # Step 2: Align the generated audio
+        await warmup
         logger.info("Running Whisper alignment...")
 
         # Detect language from input if not provided
-        language = request.language
-        if not language:
-            # Simple heuristic - could be improved
-            if any('\u3040' <= c <= '\u309f' or '\u30a0' <= c <= '\u30ff' for c in request.input):
-                language = "ja"
-            elif any('\u4e00' <= c <= '\u9fff' for c in request.input):
-                language = "zh"
-            else:
-                language = "en"
+        language = request.language or detect_language(request.input)
 
-        words = transcribe_with_word_timestamps(audio_bytes, language)
+        words = await run_alignment(audio_bytes, language)
         logger.info(f"Alignment found {len(words)} words")
 
-        # Step 3: Return combined response
+        # Step 3: Return combined response (encode off the event loop too)
+        audio_b64 = await asyncio.to_thread(pybase64.b64encode_as_string, audio_bytes)
         return SpeechWithAlignmentResponse(
-            audio=base64.b64encode(audio_bytes).decode("utf-8"),
+            audio=audio_b64,
             words=words,
             format=request.response_format
         )
@@ -349,13 +493,17 @@ async def proxy_web(path: str = ""):
         raise HTTPException(status_code=503, detail="TTS service unavailable")
 
 
-@app.get("/docs")
-async def docs_redirect():
-    """Redirect to FastAPI auto-generated docs."""
-    from fastapi.responses import RedirectResponse
-    return RedirectResponse(url="/docs")
-
-
 if __name__ == "__main__":
+    import sys
+
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        # uvloop/httptools cut event-loop and HTTP-parse overhead on the
+        # many cheap proxied endpoints (Linux/macOS; Windows falls back)
+        loop="uvloop" if sys.platform != "win32" else "auto",
+        http="httptools",
+        workers=int(os.getenv("UVICORN_WORKERS", "1"))
+    )